@@ -37,6 +37,12 @@ from .constants import (
 
 PLUGIN_VERSION = "0.7.0"
 
+# Qt < 5.15 names this attribute HTTP2AllowedAttribute
+HTTP2_ALLOWED_ATTRIBUTE = getattr(
+    QNetworkRequest, 'Http2AllowedAttribute',
+    getattr(QNetworkRequest, 'HTTP2AllowedAttribute', None)
+)
+
 
 class FeltApiClient:
     """
@@ -126,6 +132,10 @@ class FeltApiClient:
         Returns information about the user
         """
         request = self._build_request(self.USER_ENDPOINT)
+        if HTTP2_ALLOWED_ATTRIBUTE is not None:
+            # let Qt negotiate HTTP/2 for this request, if the server
+            # supports it
+            request.setAttribute(HTTP2_ALLOWED_ATTRIBUTE, True)
         return QgsNetworkAccessManager.instance().get(request)
 
     def workspaces_async(self) -> QNetworkReply:
@@ -5,7 +5,8 @@ Felt API User
 import json
 from dataclasses import dataclass
 from typing import (
-    Optional
+    Optional,
+    Union
 )
 
 from .enums import ObjectType
@@ -23,9 +24,9 @@ class User:
     type: Optional[ObjectType]
 
     @staticmethod
-    def from_json(jsons: str) -> 'User':
+    def from_json(jsons: Union[str, bytes]) -> 'User':
         """
-        Creates a user from a JSON string
+        Creates a user from a JSON string or UTF-8 encoded bytes
         """
         res = json.loads(jsons)
         return User(
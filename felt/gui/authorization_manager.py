@@ -2,9 +2,13 @@
 Felt Authorization Manager
 """
 
-import platform
-from functools import partial
-from typing import Optional
+import json
+import sys
+from collections import deque
+from typing import (
+    Optional,
+    Union
+)
 
 from qgis.PyQt import sip
 from qgis.PyQt.QtCore import (
@@ -42,6 +46,8 @@ from ..core import (
 AUTH_CONFIG_ID = "felt_auth_id"
 AUTH_CONFIG_EXPIRY = "felt_auth_expiry"
 
+_IS_DARWIN = sys.platform == "darwin"
+
 
 class AuthorizationManager(QObject):
     """
@@ -57,95 +63,165 @@ class AuthorizationManager(QObject):
 
         self.status: AuthState = AuthState.NotAuthorized
         self._workflow: Optional[OAuthWorkflow] = None
-        self.oauth_close_timer: Optional[QTimer] = None
+        self.oauth_close_timer = QTimer(self)
+        self.oauth_close_timer.setSingleShot(True)
+        self.oauth_close_timer.setInterval(1000)
+        self.oauth_close_timer.timeout.connect(self._close_auth_server)
 
         self._authorizing_message = None
         self._authorization_failed_message = None
 
-        self.queued_callbacks = []
+        self.queued_callbacks = deque()
         self.user: Optional[User] = None
         self._user_reply: Optional[QNetworkReply] = None
 
-        self.login_action = QAction(self.tr('Sign In…'))
+        # in-memory copy of the stored token, to avoid hitting the auth
+        # database/settings every time the token is retrieved
+        self._cached_token: Optional[str] = None
+        # token expiry, as a Julian day number
+        self._cached_expiry: Optional[int] = None
+
+        # translated strings, looked up once
+        self._tr_felt = self.tr('Felt')
+        self._tr_authorizing = self.tr('Authorizing…')
+        self._tr_authorized = self.tr('Authorized')
+        self._tr_sign_in = self.tr('Sign In…')
+        self._tr_log_out = self.tr('Log Out')
+        self._tr_try_again = self.tr('Try Again')
+        self._tr_auth_err = self.tr('Authorization error - {}')
+
+        # login action text and enabled state for each status
+        self._status_labels = {
+            AuthState.NotAuthorized: (self._tr_sign_in, True),
+            AuthState.Authorizing: (self._tr_authorizing, False),
+            AuthState.Authorized: (self._tr_log_out, True),
+        }
+
+        self.login_action = QAction(self._tr_sign_in, self)
         self.login_action.triggered.connect(self._login_action_triggered)
 
-    @staticmethod
-    def remove_api_token():
+    def remove_api_token(self):
         """
         Remove stored API token
         """
-        if platform.system() == "Darwin":
+        if _IS_DARWIN:
             # remove stored plain text tokens on MacOS
             QgsSettings().remove("felt/token", QgsSettings.Plugins)
         else:
-            QgsApplication.authManager().removeAuthSetting(AUTH_CONFIG_ID)
+            auth_manager = QgsApplication.authManager()
+            auth_manager.removeAuthSetting(AUTH_CONFIG_ID)
+            auth_manager.removeAuthSetting(AUTH_CONFIG_EXPIRY)
 
-    @staticmethod
-    def store_api_token(token: str, expiry: int) -> bool:
+        self._cached_token = None
+        self._cached_expiry = None
+
+    def store_api_token(self, token: str, expiry: int) -> bool:
         """
         Stores the API token in the secure QGIS password store, IF available
 
         Returns True if the key could be stored
         """
-        expiry_day = QDate.currentDate().addDays(int(expiry / 60 / 60 / 24))
-        if platform.system() == "Darwin":
+        expiry_day = QDate.currentDate().toJulianDay() + expiry // 86400
+        if _IS_DARWIN:
             # store tokens in plain text on MacOS as keychain isn't
             # available due to MacOS security
-            QgsSettings().setValue(
+            settings = QgsSettings()
+            settings.setValue(
                 "felt/token", token, QgsSettings.Plugins
             )
-            QgsSettings().setValue(
+            settings.setValue(
                 "felt/token_expiry",
-                expiry_day.toString('yyyy-MM-dd'),
+                str(expiry_day),
                 QgsSettings.Plugins
             )
         else:
+            # store the token and expiry together, so that only a single
+            # write to the auth database is required
             QgsApplication.authManager().storeAuthSetting(
-                AUTH_CONFIG_ID, token, True
-            )
-            QgsApplication.authManager().storeAuthSetting(
-                AUTH_CONFIG_EXPIRY,
-                expiry_day.toString('yyyy-MM-dd'),
+                AUTH_CONFIG_ID,
+                json.dumps({'token': token, 'expiry': expiry_day}),
                 True
             )
+
+        self._cached_token = token
+        self._cached_expiry = expiry_day
         return True
 
     @staticmethod
-    def retrieve_api_token() -> Optional[str]:
+    def _parse_token_expiry(token_expiry: Union[str, int, None]) -> int:
         """
-        Retrieves a previously stored API token, if available
+        Parses a stored token expiry value to a Julian day number
 
-        Returns None if no stored token is available
+        Returns 0 (i.e. long expired) if no valid expiry is stored, so that
+        a missing token is cached and not repeatedly queried for
         """
-        if platform.system() == "Darwin":
-            api_token = QgsSettings().value(
-                "felt/token", None, str, QgsSettings.Plugins
-            )
-            token_expiry = QgsSettings().value(
-                "felt/token_expiry", None, str, QgsSettings.Plugins
-            )
-            if not api_token:
-                api_token = None
-        else:
-            api_token = (
-                    QgsApplication.authManager().authSetting(
-                        AUTH_CONFIG_ID, defaultValue="", decrypt=True
-                    ) or None
-            )
-            token_expiry = (
-                    QgsApplication.authManager().authSetting(
-                        AUTH_CONFIG_EXPIRY, defaultValue="", decrypt=True
-                    ) or None
-            )
+        if not token_expiry:
+            return 0
 
-        if token_expiry:
-            token_expiry_date = QDate.fromString(token_expiry, 'yyyy-MM-dd')
-            if token_expiry_date <= QDate.currentDate():
-                api_token = None
-        else:
-            api_token = None
+        try:
+            return int(token_expiry)
+        except ValueError:
+            # tokens stored by older plugin versions use an ISO date string
+            expiry_date = QDate.fromString(token_expiry, 'yyyy-MM-dd')
+            return expiry_date.toJulianDay() if expiry_date.isValid() else 0
 
-        return api_token
+    def retrieve_api_token(self) -> Optional[str]:
+        """
+        Retrieves a previously stored API token, if available
+
+        Returns None if no stored token is available
+        """
+        if self._cached_expiry is None:
+            if _IS_DARWIN:
+                settings = QgsSettings()
+                api_token = settings.value(
+                    "felt/token", None, str, QgsSettings.Plugins
+                )
+                token_expiry = settings.value(
+                    "felt/token_expiry", None, str, QgsSettings.Plugins
+                )
+            else:
+                auth_manager = QgsApplication.authManager()
+                stored_token = auth_manager.authSetting(
+                    AUTH_CONFIG_ID, defaultValue="", decrypt=True
+                )
+                try:
+                    token_details = json.loads(stored_token)
+                except ValueError:
+                    token_details = None
+
+                if isinstance(token_details, dict):
+                    api_token = token_details.get('token')
+                    token_expiry = token_details.get('expiry')
+                elif stored_token:
+                    # tokens stored by older plugin versions keep the
+                    # expiry in a separate setting. Migrate these to the
+                    # combined setting and remove the legacy expiry, so
+                    # that it can't be paired with the combined setting
+                    api_token = stored_token
+                    token_expiry = self._parse_token_expiry(
+                        auth_manager.authSetting(
+                            AUTH_CONFIG_EXPIRY, defaultValue="", decrypt=True
+                        )
+                    )
+                    auth_manager.storeAuthSetting(
+                        AUTH_CONFIG_ID,
+                        json.dumps(
+                            {'token': api_token, 'expiry': token_expiry}
+                        ),
+                        True
+                    )
+                    auth_manager.removeAuthSetting(AUTH_CONFIG_EXPIRY)
+                else:
+                    api_token, token_expiry = None, None
+
+            self._cached_token = api_token or None
+            self._cached_expiry = self._parse_token_expiry(token_expiry)
+
+        if self._cached_expiry <= QDate.currentDate().toJulianDay():
+            return None
+
+        return self._cached_token
 
     def _set_status(self, status: AuthState):
         """
@@ -157,17 +233,11 @@ class AuthorizationManager(QObject):
         self.status = status
         self.status_changed.emit(self.status)
 
-        if self.status == AuthState.NotAuthorized:
-            self.login_action.setText(self.tr('Sign In…'))
-            self.login_action.setEnabled(True)
-            self.user = None
-        elif self.status == AuthState.Authorizing:
-            self.login_action.setText(self.tr('Authorizing…'))
-            self.login_action.setEnabled(False)
+        text, enabled = self._status_labels[status]
+        self.login_action.setText(text)
+        self.login_action.setEnabled(enabled)
+        if status != AuthState.Authorized:
             self.user = None
-        elif self.status == AuthState.Authorized:
-            self.login_action.setText(self.tr('Log Out'))
-            self.login_action.setEnabled(True)
 
     def is_authorized(self) -> bool:
         """
@@ -204,23 +274,28 @@ class AuthorizationManager(QObject):
         """
         self._set_status(AuthState.NotAuthorized)
         API_CLIENT.set_token(None)
-        AuthorizationManager.remove_api_token()
+        self.remove_api_token()
 
     def attempt_authorize(self):
         """
         Tries to authorize the client, using previously fetched token if
         available. Otherwise shows the login dialog to the user.
         """
-        previous_token = AuthorizationManager.retrieve_api_token()
+        if self.status == AuthState.Authorizing:
+            # an authorization is already in progress, and any queued
+            # callbacks will be called when it completes
+            return
+
+        previous_token = self.retrieve_api_token()
         if previous_token:
             self._cleanup_messages()
 
             self._set_status(AuthState.Authorized)
             API_CLIENT.set_token(previous_token)
             self.authorized.emit()
-            self._user_reply = API_CLIENT.user()
-            self._user_reply.finished.connect(partial(self._set_user_details,
-                                                      self._user_reply))
+            reply = API_CLIENT.user()
+            self._user_reply = reply
+            reply.finished.connect(lambda r=reply: self._set_user_details(r))
             return
 
         self.show_authorization_dialog()
@@ -234,7 +309,7 @@ class AuthorizationManager(QObject):
         if dlg.exec_():
             self.start_authorization_workflow()
         else:
-            self.queued_callbacks = []
+            self.queued_callbacks = deque()
 
     def start_authorization_workflow(self):
         """
@@ -252,8 +327,8 @@ class AuthorizationManager(QObject):
 
         self._set_status(AuthState.Authorizing)
 
-        self._authorizing_message = QgsMessageBarItem(self.tr('Felt'),
-                                                      self.tr('Authorizing…'),
+        self._authorizing_message = QgsMessageBarItem(self._tr_felt,
+                                                      self._tr_authorizing,
                                                       Qgis.MessageLevel.Info)
         iface.messageBar().pushItem(self._authorizing_message)
 
@@ -264,40 +339,40 @@ class AuthorizationManager(QObject):
         """
         Removes outdated message bar items
         """
-        if self._authorizing_message and not sip.isdeleted(
-                self._authorizing_message):
-            iface.messageBar().popWidget(self._authorizing_message)
+        message = self._authorizing_message
+        if message is not None and not sip.isdeleted(message):
+            iface.messageBar().popWidget(message)
             self._authorizing_message = None
-        if self._authorization_failed_message and not sip.isdeleted(
-                self._authorization_failed_message):
-            iface.messageBar().popWidget(self._authorization_failed_message)
+        message = self._authorization_failed_message
+        if message is not None and not sip.isdeleted(message):
+            iface.messageBar().popWidget(message)
             self._authorization_failed_message = None
 
     def _authorization_error_occurred(self, error: str):
         """
         Triggered when an authorization error occurs
         """
-        self.queued_callbacks = []
+        self.queued_callbacks = deque()
         self._cleanup_messages()
 
         self._clean_workflow()
 
         self._set_status(AuthState.NotAuthorized)
-        login_error = self.tr('Authorization error - {}'.format(error))
+        login_error = self._tr_auth_err.format(error)
 
         self._authorization_failed_message = QgsMessageBarItem(
-            self.tr('Felt'),
+            self._tr_felt,
             login_error,
             Qgis.MessageLevel.Critical
         )
 
-        retry_button = QPushButton(self.tr("Try Again"))
+        retry_button = QPushButton(self._tr_try_again)
         retry_button.clicked.connect(self.show_authorization_dialog)
         self._authorization_failed_message.layout().addWidget(retry_button)
 
         iface.messageBar().pushItem(self._authorization_failed_message)
 
-        self.queued_callbacks = []
+        self.queued_callbacks = deque()
         self.authorization_failed.emit()
 
     def _authorization_success(self, token: str, expiry: int):
@@ -307,17 +382,17 @@ class AuthorizationManager(QObject):
         self._cleanup_messages()
 
         self._set_status(AuthState.Authorized)
-        iface.messageBar().pushSuccess(self.tr('Felt'), self.tr('Authorized'))
+        iface.messageBar().pushSuccess(self._tr_felt, self._tr_authorized)
         API_CLIENT.set_token(token)
-        AuthorizationManager.store_api_token(token, expiry)
+        self.store_api_token(token, expiry)
 
         self._clean_workflow()
 
         self.authorized.emit()
 
-        self._user_reply = API_CLIENT.user()
-        self._user_reply.finished.connect(partial(self._set_user_details,
-                                                  self._user_reply))
+        reply = API_CLIENT.user()
+        self._user_reply = reply
+        reply.finished.connect(lambda r=reply: self._set_user_details(r))
 
     def _set_user_details(self, reply: QNetworkReply):
         """
@@ -342,9 +417,9 @@ class AuthorizationManager(QObject):
             self._user_reply = None
             return
 
-        self.user = User.from_json(reply.readAll().data().decode())
+        self.user = User.from_json(reply.readAll().data())
         callbacks = self.queued_callbacks
-        self.queued_callbacks = []
+        self.queued_callbacks = deque()
         for callback in callbacks:
             callback()
 
@@ -353,8 +428,9 @@ class AuthorizationManager(QObject):
         Must be called when the authorization handler needs to be gracefully
         shutdown (e.g. on plugin unload)
         """
-        if self._user_reply and not sip.isdeleted(self._user_reply):
-            self._user_reply.deleteLater()
+        reply = self._user_reply
+        if reply is not None and not sip.isdeleted(reply):
+            reply.deleteLater()
         self._user_reply = None
 
         self._close_auth_server(force_close=True)
@@ -364,31 +440,24 @@ class AuthorizationManager(QObject):
         Cleans up the oauth workflow
         """
         if self._workflow and not sip.isdeleted(self._workflow):
-            self.oauth_close_timer = QTimer(self)
-            self.oauth_close_timer.setSingleShot(True)
-            self.oauth_close_timer.setInterval(1000)
-            self.oauth_close_timer.timeout.connect(self._close_auth_server)
             self.oauth_close_timer.start()
 
     def _close_auth_server(self, force_close=False):
         """
         Gracefully closes and cleans up the oauth workflow
         """
-        if self.oauth_close_timer and not sip.isdeleted(
-                self.oauth_close_timer):
-            self.oauth_close_timer.timeout.disconnect(
-                self._close_auth_server)
-            self.oauth_close_timer.deleteLater()
-        self.oauth_close_timer = None
+        if not sip.isdeleted(self.oauth_close_timer):
+            self.oauth_close_timer.stop()
 
-        if self._workflow and not sip.isdeleted(self._workflow):
+        workflow = self._workflow
+        if workflow is not None and not sip.isdeleted(workflow):
             if force_close:
-                self._workflow.force_stop()
+                workflow.force_stop()
 
-            self._workflow.close_server()
-            self._workflow.quit()
-            self._workflow.wait()
-            self._workflow.deleteLater()
+            workflow.close_server()
+            workflow.quit()
+            workflow.wait()
+            workflow.deleteLater()
 
         self._workflow = None
 